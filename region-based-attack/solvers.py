@@ -6,9 +6,10 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def solve_lp(c, G=None, h=None, C=None, d=None, init_x=None, n_jobs=1, solver=cp.CVXOPT):
+def solve_lp(c, G=None, h=None, C=None, d=None, init_x=None, n_jobs=1, solver=cp.CVXOPT, **kwargs):
     n = len(c)
     options = {'threads': n_jobs}
+    options.update(kwargs)
     x = cp.Variable(shape=(n, 1))
     obj = cp.Minimize(c.T @ x)
     if C is not None and d is not None and G is not None and h is not None:
@@ -20,9 +21,8 @@ def solve_lp(c, G=None, h=None, C=None, d=None, init_x=None, n_jobs=1, solver=cp
     prob = cp.Problem(obj, constraints)
     if init_x is not None:
         x.value = init_x
-        prob.solve(solver=solver, warm_start=True, **options)
-    else:
-        prob.solve(solver=solver, **options)
+        options['warm_start'] = True
+    prob.solve(solver=solver, **options)
     return prob.status, x.value
 
 def solve_qp(Q, q, G, h, n, C=None, d=None, init_x=None, n_jobs=1, solver=cp.CVXOPT, **kwargs):
@@ -47,3 +47,54 @@ def solve_qp(Q, q, G, h, n, C=None, d=None, init_x=None, n_jobs=1, solver=cp.CVX
         logger.error("QP solver error:", e)
         return False, x.value
     return prob.status, x.value
+
+def parametric_qp(Q):
+    """Build min 1/2 x^T Q x + q^T x s.t. lo <= x <= hi with q, lo, hi as
+    cp.Parameter, so the problem is canonicalized only once and can be
+    re-solved after updating the parameter values. An equality is set as
+    lo == hi.
+
+    Returns:
+        (problem, variable, dict of parameters)
+    """
+    n = Q.shape[0]
+    x = cp.Variable(shape=(n, 1))
+    params = {
+        'q': cp.Parameter((n, 1)),
+        'lo': cp.Parameter((n, 1)),
+        'hi': cp.Parameter((n, 1)),
+    }
+    obj = cp.Minimize((1/2)*cp.quad_form(x, Q) + params['q'].T @ x)
+    constraints = [params['lo'] <= x, x <= params['hi']]
+    return cp.Problem(obj, constraints), x, params
+
+def parametric_linf(n):
+    """Build min t s.t. |x - y| <= t, t >= 0, lo <= x <= hi, the Linf
+    distance from y to a box, with y, lo, hi as cp.Parameter, see
+    parametric_qp.
+
+    Returns:
+        (problem, variable x, dict of parameters)
+    """
+    x = cp.Variable(shape=(n, 1))
+    t = cp.Variable(nonneg=True)
+    params = {
+        'y': cp.Parameter((n, 1)),
+        'lo': cp.Parameter((n, 1)),
+        'hi': cp.Parameter((n, 1)),
+    }
+    constraints = [
+        x - params['y'] <= t, params['y'] - x <= t,
+        params['lo'] <= x, x <= params['hi'],
+    ]
+    return cp.Problem(cp.Minimize(t), constraints), x, params
+
+def solve_parametric(prob, x, solver=cp.CVXOPT, **kwargs):
+    """Re-solve a problem from parametric_qp/parametric_linf, warm started
+    from the previous solution."""
+    try:
+        prob.solve(solver=solver, warm_start=True, **kwargs)
+    except cp.error.SolverError as e:
+        logger.error("Solver error: %s", e)
+        return False, x.value
+    return prob.status, x.value
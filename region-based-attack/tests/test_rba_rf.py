@@ -8,8 +8,13 @@ import numpy as np
 from numpy.testing import assert_almost_equal
 from sklearn.datasets import load_svmlight_file
 from sklearn.ensemble import RandomForestClassifier
+import cvxpy as cp
+import joblib
 
-from ..tree.rf_attack import RFAttack
+from ..tree.rf_attack import (RFAttack, constraint_list_to_matrix, region_feasibility,
+                              union_constraints)
+from ..tree.tree_utils import get_tree_constraints
+from ..solvers import solve_lp
 
 
 class TestRFAttack(unittest.TestCase):
@@ -24,6 +29,40 @@ class TestRFAttack(unittest.TestCase):
         self.tstX, self.tsty = self.X[100:110], self.y[100:110]
         self.clf = RandomForestClassifier(n_estimators=3, max_depth=3, random_state=0).fit(self.trnX, self.trny)
 
+    def test_region_feasibility(self):
+        n_dim = self.X.shape[1]
+
+        def _lp_feasible(r):
+            G, h, C, d = constraint_list_to_matrix(r)
+            G, h = (G, h.reshape((-1, 1))) if len(G) > 0 else (None, None)
+            if C is not None:
+                d = d.reshape((-1, 1))
+            status, _ = solve_lp(np.zeros((n_dim, 1)), G, h, C, d, solver=cp.GLPK)
+            return status == 'optimal'
+
+        # intersections of the leaves of the first two trees
+        leaf_rs = []
+        for tree_clf in self.clf.estimators_[:2]:
+            _, constraint = get_tree_constraints(tree_clf)
+            leaf_rs.append([union_constraints(G, h) for G, h in constraint])
+        rs = np.array([np.minimum(r1, r2) for r1 in leaf_rs[0] for r2 in leaf_rs[1]])
+
+        # x_0 <= 0.3 and x_0 >= 0.3 + 1e-9 is close enough to an equality,
+        # x_0 <= 0.3 and x_0 >= 0.4 is not
+        r = np.full(2*n_dim, np.inf)
+        r[0], r[n_dim] = 0.3, -(0.3 + 1e-9)
+        rs = np.vstack((rs, r))
+        r = r.copy()
+        r[n_dim] = -0.4
+        rs = np.vstack((rs, r))
+
+        feasible = region_feasibility(rs)
+        self.assertTrue(np.any(feasible) and np.any(~feasible))
+        self.assertTrue(feasible[-2])
+        self.assertFalse(feasible[-1])
+        for r, f in zip(rs, feasible):
+            self.assertEqual(_lp_feasible(r), f)
+
     def test_realdata_rf(self):
         trnX, trny, tstX, tsty, clf = self.trnX, self.trny, self.tstX, self.tsty, self.clf
 
@@ -66,5 +105,77 @@ class TestRFAttack(unittest.TestCase):
                     pert_dist, decimal=3
                 )
 
+    def test_realdata_rf_approx_n_searches(self):
+        trnX, trny, tstX, tsty, clf = self.trnX, self.trny, self.tstX, self.tsty, self.clf
+
+        for norm in [2, np.inf]:
+            attack = RFAttack(trnX=trnX, trny=trny, clf=clf, method='rev', norm=norm,
+                              n_searches=5, n_jobs=1)
+            # the training data keeps the order it was given in
+            assert_almost_equal(attack.trnX, trnX)
+            assert_almost_equal(attack.trny, trny)
+            perturb = attack.perturb(tstX, tsty)
+
+            self.assertTrue(clf.score(tstX + perturb, tsty) == 0.)
+
+            pert_dist = np.linalg.norm(perturb, ord=norm, axis=1)
+            if norm == 2:
+                assert_almost_equal(
+                    [0., 0.517, 0., 0.282, 0.35, 0.127, 0.605, 0.065, 0.01, 0.],
+                    pert_dist, decimal=3
+                )
+            elif norm == np.inf:
+                assert_almost_equal(
+                    [0., 0.517, 0., 0.273, 0.35, 0.117, 0.459, 0.061, 0.01, 0.],
+                    pert_dist, decimal=3
+                )
+
+    def test_realdata_rf_n_jobs(self):
+        trnX, trny, tstX, tsty, clf = self.trnX, self.trny, self.tstX, self.tsty, self.clf
+
+        for method in ['all', 'rev']:
+            for norm in [2, np.inf]:
+                pert_dists = []
+                for n_jobs in [1, 2]:
+                    attack = RFAttack(trnX=trnX, trny=trny, clf=clf, method=method,
+                                      norm=norm, n_jobs=n_jobs)
+                    perturb = attack.perturb(tstX, tsty)
+
+                    self.assertTrue(clf.score(tstX + perturb, tsty) == 0.)
+                    pert_dists.append(np.linalg.norm(perturb, ord=norm, axis=1))
+                assert_almost_equal(pert_dists[0], pert_dists[1], decimal=3)
+
+    def test_realdata_rf_threading(self):
+        trnX, trny, tstX, tsty, clf = self.trnX, self.trny, self.tstX, self.tsty, self.clf
+
+        for method in ['all', 'rev']:
+            for norm in [2, np.inf]:
+                attack = RFAttack(trnX=trnX, trny=trny, clf=clf, method=method,
+                                  norm=norm, n_jobs=1)
+                pert_dist = np.linalg.norm(attack.perturb(tstX, tsty), ord=norm, axis=1)
+
+                with joblib.parallel_backend('threading', n_jobs=4):
+                    attack = RFAttack(trnX=trnX, trny=trny, clf=clf, method=method,
+                                      norm=norm, n_jobs=4)
+                    perturb = attack.perturb(tstX, tsty)
+
+                self.assertTrue(clf.score(tstX + perturb, tsty) == 0.)
+                assert_almost_equal(pert_dist, np.linalg.norm(perturb, ord=norm, axis=1),
+                                    decimal=3)
+
+    def test_realdata_rf_qp_solver(self):
+        trnX, trny, tstX, tsty, clf = self.trnX, self.trny, self.tstX, self.tsty, self.clf
+
+        for method in ['all', 'rev']:
+            pert_dists = []
+            for qp_solver in [cp.OSQP, cp.CVXOPT]:
+                attack = RFAttack(trnX=trnX, trny=trny, clf=clf, method=method,
+                                  norm=2, qp_solver=qp_solver, n_jobs=2)
+                perturb = attack.perturb(tstX, tsty)
+
+                self.assertTrue(clf.score(tstX + perturb, tsty) == 0.)
+                pert_dists.append(np.linalg.norm(perturb, ord=2, axis=1))
+            assert_almost_equal(pert_dists[0], pert_dists[1], decimal=3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,10 @@
 from typing import List
 import gc
+import threading
 from functools import partial
-from itertools import product, permutations
 
 import numpy as np
+from scipy import sparse
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KDTree
 from tqdm import tqdm
@@ -13,177 +14,358 @@ import cvxpy as cp
 
 from ..base import AttackModel
 from .tree_utils import get_tree_constraints
-from ..solvers import solve_lp, solve_qp
+from ..solvers import parametric_linf, parametric_qp, solve_parametric
 from ..knn import sol_sat_constraints, CONSTRAINTTOL
 
+# number of regions _solve_pruned solves (and predicts at once) between two
+# pruning steps, within a single job
+PRUNE_BATCH_SIZE = 16
+
 def constraint_list_to_matrix(r):
-    rG, rh = [], []
-    rC, rd = [], []
+    r = np.asarray(r)
     n_dim = len(r) // 2
-
-    for i in range(n_dim):
-        temp = np.zeros(n_dim)
-        temp[i] = 1
-        if np.isclose(r[i], -r[i+n_dim]):
-            rC.append(temp)
-            rd.append(r[i])
-        else:
-            temp2 = np.zeros(n_dim)
-            temp2[i] = -1
-            rG.append(temp)
-            rh.append(r[i])
-            rG.append(temp2)
-            rh.append(r[i+n_dim])
-
-    rG, rh = np.array(rG).astype(np.float32), np.array(rh).astype(np.float32)
-    if len(rC) == 0 or len(rd) == 0:
+    eye = np.eye(n_dim, dtype=np.float32)
+    eq = np.isclose(r[:n_dim], -r[n_dim:])
+
+    # x_i <= r[i] and -x_i <= r[i+n_dim] for the other dimensions, skipping
+    # the infinite bounds
+    ineq = np.where(~eq)[0]
+    rG = np.empty((2*len(ineq), n_dim), dtype=np.float32)
+    rG[0::2], rG[1::2] = eye[ineq], -eye[ineq]
+    rh = np.empty(2*len(ineq), dtype=np.float32)
+    rh[0::2], rh[1::2] = r[ineq], r[ineq + n_dim]
+    finite = np.isfinite(rh)
+    rG, rh = rG[finite], rh[finite]
+
+    if not np.any(eq):
         rC, rd = None, None
     else:
-        rC, rd = np.array(rC).astype(np.float32), np.array(rd).astype(np.float32)
+        rC, rd = eye[eq], r[:n_dim][eq].astype(np.float32)
     return rG, rh, rC, rd
 
+def stack_regions(regions, n_dim):
+    """Stack regions in matrix form (see constraint_list_to_matrix) into
+    contiguous arrays. The rows of region i are G_all[G_ptr[i]:G_ptr[i+1]],
+    h_all[G_ptr[i]:G_ptr[i+1]], and the same for C_all, d_all with C_ptr.
+
+    Returns:
+        (G_all, G_ptr, h_all, C_all, C_ptr, d_all)
+    """
+    Gs, hs = [np.zeros((0, n_dim), np.float32)], [np.zeros(0, np.float32)]
+    Cs, ds = [np.zeros((0, n_dim), np.float32)], [np.zeros(0, np.float32)]
+    for G, h, C, d in regions:
+        Gs.append(G)
+        hs.append(h)
+        if C is not None and d is not None:
+            Cs.append(C)
+            ds.append(d)
+        else:
+            Cs.append(Cs[0])
+            ds.append(ds[0])
+    G_ptr = np.cumsum([0] + [len(h) for h in hs[1:]])
+    C_ptr = np.cumsum([0] + [len(d) for d in ds[1:]])
+    return (np.concatenate(Gs).astype(np.float32), G_ptr, np.concatenate(hs).astype(np.float32),
+            np.concatenate(Cs).astype(np.float32), C_ptr, np.concatenate(ds).astype(np.float32))
+
+def get_region(regions, i):
+    """Get the (G, h, C, d) of region i from the output of stack_regions."""
+    G_all, G_ptr, h_all, C_all, C_ptr, d_all = regions
+    G, h = G_all[G_ptr[i]:G_ptr[i+1]], h_all[G_ptr[i]:G_ptr[i+1]]
+    if C_ptr[i] == C_ptr[i+1]:
+        return G, h, None, None
+    return G, h, C_all[C_ptr[i]:C_ptr[i+1]], d_all[C_ptr[i]:C_ptr[i+1]]
+
 def union_constraints(G, h):
     assert np.all(np.abs(G).sum(1) == np.ones(len(G)))
     if len(np.shape(G)) <= 1:
         return np.array([]), np.array([])
     n_dim = np.shape(G)[1]
 
-    r = [np.inf for i in range(n_dim*2)]
-    for Gi, hi in zip(G, h):
-        if Gi.sum() == 1:
-            idx = np.where(Gi == 1)[0][0]
-            r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        elif Gi.sum() == -1:
-            idx = np.where(Gi == -1)[0][0] + n_dim
-            r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        else:
-            raise ValueError()
+    # each row of G is either e_i (x_i <= h) or -e_i (-x_i <= h)
+    sign = G.sum(1)
+    if not np.all(np.logical_or(sign == 1, sign == -1)):
+        raise ValueError()
+    idx = np.argmax(np.abs(G), axis=1) + (sign == -1) * n_dim
+
+    r = np.full(n_dim*2, np.inf)
+    np.minimum.at(r, idx, h)
     return r
 
+def region_feasibility(rs):
+    """Batched feasibility check of regions in the list form of
+    constraint_list_to_matrix.
+
+    Regions are axis-aligned boxes, so a region is non-empty iff the lower
+    bound does not exceed the upper bound on every dimension (bounds that are
+    close are treated as an equality constraint).
+
+    Arguments:
+        rs {ndarray, shape=(n_regions, 2*n_features)} -- Regions to check
+
+    Returns:
+        ndarray, shape=(n_regions) -- Whether each region is feasible
+    """
+    rs = np.atleast_2d(rs)
+    n_dim = rs.shape[1] // 2
+    hi, lo = rs[:, :n_dim], -rs[:, n_dim:]
+    return np.all(np.logical_or(lo <= hi, np.isclose(hi, lo)), axis=1)
+
+def _search_regions(t, r, preds, leaves):
+    """Search the leaf combinations of trees t, t+1, ... inside region r.
+
+    The leaves of tree t are intersected with r and checked for feasibility
+    in one batch; infeasible leaves are pruned together with every
+    combination of leaves from the remaining trees.
+
+    Returns:
+        (regions, labels predicted by each tree, number of vacuan regions)
+    """
+    if t == len(leaves):
+        return [r], [preds], 0
+
+    leaf_rs, leaf_preds = leaves[t]
+    rs = np.minimum(r, leaf_rs)
+    feasible = region_feasibility(rs)
+
+    regions, region_labels = [], []
+    n_rest = int(np.prod([len(l[1]) for l in leaves[t+1:]]))
+    vacuan_regions = int(np.sum(~feasible)) * n_rest
+    for i in np.where(feasible)[0]:
+        rets = _search_regions(t+1, rs[i], preds + [leaf_preds[i]], leaves)
+        regions.extend(rets[0])
+        region_labels.extend(rets[1])
+        vacuan_regions += rets[2]
+    return regions, region_labels, vacuan_regions
+
 def tree_instance_constraint(tree_clf, X):
     node_indicator = tree_clf.decision_path(X)
     leave_id = tree_clf.apply(X)
     feature = tree_clf.tree_.feature
     threshold = tree_clf.tree_.threshold
-    n_dims = X.shape[1]
-
-    ret = []
-    for sample_id in range(len(X)):
-        node_index = node_indicator.indices[node_indicator.indptr[sample_id]:
-                                            node_indicator.indptr[sample_id + 1]]
-        r = [np.inf for i in range(n_dims*2)]
-        for node_id in node_index:
-            if leave_id[sample_id] == node_id:
-                break
-
-            # scikit-learn uses float32 internally
-            if (X[sample_id, feature[node_id]].astype(np.float32) <= threshold[node_id]).astype(np.float32):
-                #threshold_sign = "<="
-                idx = feature[node_id]
-                hi = threshold[node_id]
-                r[idx] = hi if r[idx] is None else min(r[idx], hi)
-            else:
-                #threshold_sign = ">"
-                idx = feature[node_id] + n_dims
-                hi = -threshold[node_id]
-                r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        ret.append(r)
-
-    return np.asarray(ret).astype(np.float32)
-
-def rev_get_sol_l2(target_x, target_y: int, regions, clf, trnX=None, qp_solver=cp.CVXOPT):
-    fet_dim = np.shape(target_x)[0]
-    candidates = []
-    regions = [constraint_list_to_matrix(r) for r in regions]
-    for i, (G, h, C, d) in enumerate(regions):
-        #c = np.concatenate((np.zeros(fet_dim), np.ones(1))).reshape((-1, 1))
-
-        Q = 2 * np.eye(fet_dim)
-        q = -2 * target_x
-        temph = (h - CONSTRAINTTOL).reshape((-1, 1))
-
-        ind = np.where(np.logical_not(np.isinf(temph)))[0]
-        tempG = G[ind]
-        temph = temph[ind]
-
-        if trnX is None:
-            status, sol = solve_qp(Q, q, tempG, temph, len(q), C=C, d=d, solver=qp_solver)
-        else:
-            status, sol = solve_qp(Q, q, tempG, temph, len(q), C=C, d=d,
-                                   init_x=trnX[i].reshape((-1, 1)), solver=qp_solver)
+    n_samples, n_dims = X.shape
+    # scikit-learn uses float32 internally
+    X = X.astype(np.float32, copy=False)
+
+    # flatten the CSR decision paths into (sample, node) pairs
+    sample_ids = np.repeat(np.arange(n_samples), np.diff(node_indicator.indptr))
+    node_ids = node_indicator.indices
+    internal = node_ids != leave_id[sample_ids]
+    sample_ids, node_ids = sample_ids[internal], node_ids[internal]
+
+    feat = feature[node_ids]
+    thr = threshold[node_ids]
+    leq = X[sample_ids, feat] <= thr
+
+    r = np.full((n_samples, 2*n_dims), np.inf, dtype=np.float32)
+    # threshold_sign "<=" constrains x[idx] <= threshold
+    np.minimum.at(r, (sample_ids[leq], feat[leq]), thr[leq].astype(np.float32))
+    # threshold_sign ">" constrains -x[idx] <= -threshold
+    np.minimum.at(r, (sample_ids[~leq], feat[~leq] + n_dims),
+                  -thr[~leq].astype(np.float32))
 
-        if status == 'optimal':
-            ret = np.array(sol).reshape(-1)
+    return r
 
-            if clf.predict([ret])[0] != target_y:
-                candidates.append(ret - target_x)
-            else:
-                # a dimension is too close to the boundary region too small
-                # just use the traning data as
-                if trnX is not None:
-                    candidates.append(trnX[i] - target_x)
-        elif status == 'infeasible_inaccurate':
-            print(status)
-            candidates.append(trnX[i] - target_x)
+def set_region_params(params, center, G, h, C=None, d=None):
+    """Set the lo, hi parameters of a parametric problem to the box of a
+    region. Every row of G is +-e_i and every row of C is e_i (see
+    constraint_list_to_matrix), so a row bounds a single dimension.
+
+    An equality sets lo == hi. An infinite bound is replaced by a finite one
+    past both center and the opposite bound, which keeps the closest point
+    of the box to center inside it.
+    """
+    n_dim = params['lo'].shape[0]
+    lo, hi = np.full(n_dim, -np.inf), np.full(n_dim, np.inf)
+    if len(G) > 0:
+        dims = np.argmax(np.abs(G), axis=1)
+        upper = G[np.arange(len(G)), dims] > 0
+        hi[dims[upper]] = h[upper]
+        lo[dims[~upper]] = -h[~upper]
+    if C is not None and d is not None:
+        dims = np.argmax(np.abs(C), axis=1)
+        lo[dims] = hi[dims] = d
+    lo_inf, hi_inf = np.isinf(lo), np.isinf(hi)
+    lo[lo_inf] = np.fmin(center, hi)[lo_inf] - 1
+    hi[hi_inf] = np.fmax(center, lo)[hi_inf] + 1
+    params['lo'].value = lo.reshape((-1, 1))
+    params['hi'].value = hi.reshape((-1, 1))
+
+def l2_problem(fet_dim):
+    """Parametric QP of the L2 attack on a region, see _solve_regions_l2."""
+    return parametric_qp(2 * sparse.eye(fet_dim, format='csc'))
+
+def linf_problem(fet_dim):
+    """Parametric LP of the Linf attack on a region, see _solve_regions_linf."""
+    return parametric_linf(fet_dim)
+
+# attack problems built in this thread, see get_problem
+_PROBLEMS = threading.local()
+
+def get_problem(norm, fet_dim):
+    """Parametric attack problem of the norm, built once per thread.
+
+    CVXPY problems are not sent to the joblib workers: once unpickled their
+    object ids can collide with the ones created in the worker, so every
+    process builds (and canonicalizes) its own. They are not shared between
+    threads either, since solving one sets its parameters and warm start.
+    """
+    if not hasattr(_PROBLEMS, 'cache'):
+        _PROBLEMS.cache = {}
+    key = (norm, fet_dim)
+    if key not in _PROBLEMS.cache:
+        if norm == 2:
+            _PROBLEMS.cache[key] = l2_problem(fet_dim)
         else:
-            print(status)
-
-    norms = np.linalg.norm(candidates, ord=2, axis=1)
+            _PROBLEMS.cache[key] = linf_problem(fet_dim)
+    return _PROBLEMS.cache[key]
+
+def _solve_box(prob, x, params, solver):
+    """solve_parametric, with the solution clipped into [lo, hi]: interior
+    point solvers only approach the equalities lo == hi.
+
+    A region the solver fails on, or solves inaccurately (OSQP can stop at
+    its iteration limit), is solved again with CVXOPT instead of dropped.
+    """
+    status, sol = solve_parametric(prob, x, solver=solver)
+    if status in (False, cp.OPTIMAL_INACCURATE) and solver != cp.CVXOPT:
+        status, sol = solve_parametric(prob, x, solver=cp.CVXOPT)
+    if sol is not None:
+        sol = np.clip(sol, params['lo'].value, params['hi'].value)
+    return status, sol
+
+def _solve_regions_l2(target_x, regions, region_ids, qp_solver):
+    """Solve the L2 QP of each region, warm starting from the previous one."""
+    prob, x, params = get_problem(2, np.shape(target_x)[0])
+    params['q'].value = (-2 * target_x).reshape((-1, 1))
+
+    rets = []
+    for i in region_ids:
+        G, h, C, d = get_region(regions, i)
+        set_region_params(params, target_x, G, h - CONSTRAINTTOL, C, d)
+        rets.append(_solve_box(prob, x, params, qp_solver))
+    return rets
+
+def _solve_regions_linf(target_x, regions, region_ids, lp_solver):
+    """Solve the Linf LP of each region, warm starting from the previous one."""
+    prob, x, params = get_problem(np.inf, np.shape(target_x)[0])
+    params['y'].value = target_x.reshape((-1, 1))
+
+    rets = []
+    for i in region_ids:
+        G, h, C, d = get_region(regions, i)
+        set_region_params(params, target_x, G, h - CONSTRAINTTOL, C, d)
+        rets.append(_solve_box(prob, x, params, lp_solver))
+    return rets
+
+def region_lower_bounds(target_x, regions, region_ids):
+    """Lower bound of the distance from target_x to each region, in any Lp
+    norm: every row of G and C is +-e_i, so no point of the region is closer
+    than the largest violated constraint."""
+    G_all, G_ptr, h_all, C_all, C_ptr, d_all = regions
+    region_ids = np.asarray(region_ids, dtype=int)
+
+    def _segment_max(A, b, ptr, abs_val):
+        # max of the violations of rows ptr[i]:ptr[i+1] (and 0) for each
+        # region i of region_ids, computed on these rows only
+        starts, lens = ptr[region_ids], ptr[region_ids+1] - ptr[region_ids]
+        sub_ptr = np.concatenate(([0], np.cumsum(lens)))
+        rows = np.arange(sub_ptr[-1]) + np.repeat(starts - sub_ptr[:-1], lens)
+        vals = np.dot(A[rows], target_x) - b[rows]
+        if abs_val:
+            vals = np.abs(vals)
+        ret = np.zeros(len(region_ids))
+        nonempty = lens > 0
+        if np.any(nonempty):
+            ret[nonempty] = np.maximum.reduceat(vals, sub_ptr[:-1][nonempty])
+        return np.maximum(ret, 0)
+
+    return np.maximum(_segment_max(G_all, h_all, G_ptr, False),
+                      _segment_max(C_all, d_all, C_ptr, True))
+
+def _solve_pruned(solve_fn, ord, target_x, target_y: int, regions, region_ids,
+                  lbs, clf, trnX, solver):
+    """Solve the regions in the given order, PRUNE_BATCH_SIZE at a time, and
+    prune the ones whose lower bound exceeds the closest candidate found so
+    far. Returns the candidates keyed by their position in region_ids."""
+    candidates = {}
+    best_norm = np.inf
+    for start in range(0, len(region_ids), PRUNE_BATCH_SIZE):
+        batch = np.arange(start, min(start+PRUNE_BATCH_SIZE, len(region_ids)))
+        batch = batch[lbs[batch] <= best_norm]
+        if len(batch) == 0:
+            break
+        rets = solve_fn(target_x, regions, region_ids[batch], solver)
+
+        # predict all the optimal solutions at once, in the order of rets
+        sols = [np.array(sol).reshape(-1) for status, sol in rets if status == 'optimal']
+        preds = iter(clf.predict(sols) if len(sols) > 0 else [])
+        for i, (status, sol) in zip(batch, rets):
+            if status == 'optimal':
+                ret = np.array(sol).reshape(-1)
+
+                if next(preds) != target_y:
+                    candidates[i] = ret - target_x
+                else:
+                    # a dimension is too close to the boundary region too small
+                    # just use the traning data as
+                    if trnX is not None:
+                        candidates[i] = trnX[i] - target_x
+            elif status == 'infeasible_inaccurate':
+                print(status)
+                candidates[i] = trnX[i] - target_x
+            else:
+                print(status)
+
+            if i in candidates:
+                best_norm = min(best_norm, np.linalg.norm(candidates[i], ord=ord))
+    return candidates
+
+def _rev_get_sol(solve_fn, ord, target_x, target_y: int, regions, region_ids, clf,
+                 trnX, solver, n_jobs):
+    """Solve the regions best-first by their lower bound, pruning the ones
+    that cannot beat the closest candidate. With n_jobs > 1 the regions are
+    dealt round-robin to the jobs in a single dispatch, and each job prunes
+    its share on its own."""
+    region_ids = np.asarray(region_ids)
+    lbs = region_lower_bounds(target_x, regions, region_ids)
+    order = np.argsort(lbs, kind='stable')
+
+    def _args(part):
+        return (solve_fn, ord, target_x, target_y, regions, region_ids[part], lbs[part],
+                clf, None if trnX is None else trnX[part], solver)
+
+    n_jobs = min(joblib.effective_n_jobs(n_jobs), max(len(order), 1))
+    parts = [order[j::n_jobs] for j in range(n_jobs)]
+    if n_jobs == 1:
+        rets = [_solve_pruned(*_args(parts[0]))]
+    else:
+        rets = Parallel(n_jobs=n_jobs)(delayed(_solve_pruned)(*_args(part)) for part in parts)
+
+    # map the candidates back to their position in region_ids
+    candidates = {part[i]: cand for part, ret in zip(parts, rets)
+                  for i, cand in ret.items()}
+    if len(candidates) == 0:
+        raise ValueError("no region was solved, see the solver errors above")
+    # break ties by the order of the regions
+    candidates = [candidates[i] for i in sorted(candidates)]
+    norms = np.linalg.norm(candidates, ord=ord, axis=1)
     return candidates[norms.argmin()]
 
-def rev_get_sol_linf(target_x, target_y: int, regions, clf,
-                     trnX=None, lp_solver=cp.GLPK):
-    fet_dim = np.shape(target_x)[0]
-    candidates = []
-    regions = [constraint_list_to_matrix(r) for r in regions]
-    for i, (G, h, C, d) in enumerate(regions):
-        c = np.concatenate((np.zeros(fet_dim), np.ones(1))).reshape((-1, 1))
-
-        G2 = np.hstack((np.eye(fet_dim), -np.ones((fet_dim, 1))))
-        G3 = np.hstack((-np.eye(fet_dim), -np.ones((fet_dim, 1))))
-        G = np.hstack((G, np.zeros((G.shape[0], 1))))
-        G = np.vstack((G, G2, G3))
-        h = np.concatenate((h, target_x, -target_x))
-
-        temph = (h - CONSTRAINTTOL).reshape((-1, 1))
-        ind = np.where(np.logical_not(np.isinf(temph)))[0]
-        tempG = G[ind]
-        temph = temph[ind]
-
-        if C is not None:
-            C = np.hstack((C, np.zeros((C.shape[0], 1))))
-
-        if trnX is None:
-            status, sol = solve_lp(c, tempG, temph, C=C, d=d, solver=lp_solver)
-        else:
-            init_x = np.concatenate((
-                trnX[i],
-                [np.linalg.norm(trnX[i]-target_x, ord=np.inf)])).reshape((-1, 1))
-            status, sol = solve_lp(c, tempG, temph, C=C, d=d, init_x=init_x, solver=lp_solver)
-
-        if status == 'optimal':
-            ret = np.array(sol).reshape(-1)[:-1]
-
-            if clf.predict([ret])[0] != target_y:
-                candidates.append(ret - target_x)
-            else:
-                # a dimension is too close to the boundary region too small
-                # just use the traning data as
-                if trnX is not None:
-                    candidates.append(trnX[i] - target_x)
-        elif status == 'infeasible_inaccurate':
-            candidates.append(trnX[i] - target_x)
-        else:
-            print(status)
+def rev_get_sol_l2(target_x, target_y: int, regions, region_ids, clf, trnX=None,
+                   qp_solver=cp.OSQP, n_jobs=1):
+    return _rev_get_sol(_solve_regions_l2, 2, target_x, target_y, regions, region_ids,
+                        clf, trnX, qp_solver, n_jobs)
 
-    norms = np.linalg.norm(candidates, ord=np.inf, axis=1)
-    return candidates[norms.argmin()]
+def rev_get_sol_linf(target_x, target_y: int, regions, region_ids, clf, trnX=None,
+                     lp_solver=cp.GLPK, n_jobs=1):
+    return _rev_get_sol(_solve_regions_linf, np.inf, target_x, target_y, regions, region_ids,
+                        clf, trnX, lp_solver, n_jobs)
 
 
 class RFAttack(AttackModel):
     def __init__(self, trnX: np.ndarray, trny: np.ndarray, clf: RandomForestClassifier,
                 norm, method: str = "all", n_searches:int = -1, lp_solver=cp.GLPK,
-                qp_solver=cp.CVXOPT, n_jobs: int = 1, verbose=0, random_state=None):
+                qp_solver=cp.OSQP, n_jobs: int = 1, verbose=0, random_state=None):
         """Attack on Random forest classifier
 
         Arguments:
@@ -198,7 +380,6 @@ class RFAttack(AttackModel):
             random_state {[type]} -- random seed (default: {None})
         """
         super().__init__()
-        paths, constraints = [], []
         self.clf = clf
         self.method = method
         self.n_searches = n_searches
@@ -211,78 +392,86 @@ class RFAttack(AttackModel):
         self.n_jobs = n_jobs
         self.verbose = verbose
         self.norm = norm
+        self.pred_trn_y = clf.predict(self.trnX)
         if self.n_searches != -1:
-            self.kd_tree = KDTree(self.trnX)
+            # one KD-tree per predicted label, so the nearest training data
+            # predicted differently from the target can be queried directly
+            self.kd_trees, self.kd_class_indices = {}, {}
+            for c in np.unique(self.pred_trn_y):
+                self.kd_class_indices[c] = np.where(self.pred_trn_y == c)[0]
+                self.kd_trees[c] = KDTree(self.trnX[self.kd_class_indices[c]])
         else:
-            self.kd_tree = None
+            self.kd_trees, self.kd_class_indices = None, None
+        self.trn_idx_by_not_class = {
+            c: np.where(self.pred_trn_y != c)[0] for c in clf.classes_}
 
         if self.method == 'all':
+            paths, constraints = [], []
             for tree_clf in clf.estimators_:
                 path, constraint = get_tree_constraints(tree_clf)
                 paths.append(path)
                 constraints.append(constraint)
 
-            n_classes = clf.n_classes_
-            n_estimators = len(clf.estimators_)
-            self.regions: List[List] = []
-            self.region_preds = []
-            vacuan_regions = 0
-
-            for res in product(range(n_classes), repeat=n_estimators):
-                perm_consts = [list() for _ in range(n_estimators)]
-
-                for i in range(n_estimators):
-                    value = clf.estimators_[i].tree_.value
-                    path = paths[i]
-                    constraint = constraints[i]
-
-                    for p in range(len(path)):
-                        if np.argmax(value[path[p][-1]]) == res[i]:
-                            perm_consts[i].append(constraint[p])
-
-                for pro in product(*perm_consts):
-                    r = union_constraints(
-                            np.vstack([j[0] for j in pro]),
-                            np.concatenate([j[1] for j in pro]),
-                        )
-                    G, h, C, d= constraint_list_to_matrix(r)
-                    try:
-                        status, _ = solve_lp(
-                                    np.zeros((len(G[0]))), G, h.reshape(-1, 1),
-                                    C=C, d=d, solver=self.lp_solver,
-                                )
-                        if status == 'optimal':
-                            self.region_preds.append(np.argmax(np.bincount(res)))
-                            self.regions.append(r)
-                        else:
-                            vacuan_regions += 1
-                    except:
-                        vacuan_regions += 1
+            # leaves of each tree as (regions, predicted labels)
+            leaves = []
+            for tree_clf, path, constraint in zip(clf.estimators_, paths, constraints):
+                value = tree_clf.tree_.value
+                leaf_rs = np.array([union_constraints(G, h) for G, h in constraint])
+                leaf_preds = np.array([np.argmax(value[p[-1]]) for p in path])
+                leaves.append((leaf_rs, leaf_preds))
+
+            leaf_rs, leaf_preds = leaves[0]
+            feasible = region_feasibility(leaf_rs)
+            rets = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(_search_regions)(1, leaf_rs[i], [leaf_preds[i]], leaves)
+                for i in np.where(feasible)[0])
+
+            regions, region_labels = [], []
+            vacuan_regions = int(np.sum(~feasible)) \
+                    * int(np.prod([len(l[1]) for l in leaves[1:]]))
+            for ret in rets:
+                regions.extend(ret[0])
+                region_labels.extend(ret[1])
+                vacuan_regions += ret[2]
+
+            # order regions by the labels predicted by each tree
+            order = sorted(range(len(regions)), key=lambda i: region_labels[i])
+            self.regions: List[List] = [regions[i] for i in order]
+            self.region_preds = [np.argmax(np.bincount(region_labels[i])) for i in order]
+            self.G_all, self.G_ptr, self.h_all, self.C_all, self.C_ptr, self.d_all = \
+                    stack_regions((constraint_list_to_matrix(r) for r in self.regions),
+                                  trnX.shape[1])
 
             if self.verbose > 0:
                 print(f"number of regions: {len(self.regions)}")
                 print(f"number of vacuan regions: {vacuan_regions}")
 
         elif self.method == 'rev':
-            r = tree_instance_constraint(clf.estimators_[0], trnX)
-            for tree_clf in clf.estimators_[1:]:
-                t = tree_instance_constraint(tree_clf, trnX)
-                r = np.min(np.concatenate(
-                    (r[np.newaxis, :], t[np.newaxis, :])), axis=0)
+            # fold the constraints of each tree as they arrive, so at most a
+            # few (n_train, 2*n_dims) arrays are alive at once
+            rs = Parallel(n_jobs=self.n_jobs, return_as='generator_unordered')(
+                delayed(tree_instance_constraint)(tree_clf, trnX)
+                for tree_clf in clf.estimators_)
+            r = next(rs)
+            for t in rs:
+                np.minimum(r, t, out=r)
+                del t
             self.regions = r
+            self.G_all, self.G_ptr, self.h_all, self.C_all, self.C_ptr, self.d_all = \
+                    stack_regions((constraint_list_to_matrix(r) for r in self.regions),
+                                  trnX.shape[1])
 
-            for i in range(len(trnX)):
-                G, h, C, d = constraint_list_to_matrix(self.regions[i])
-                if C is not None and d is not None:
-                    assert np.all(
-                            np.logical_and(
-                                np.dot(G, trnX[i]) <= (h + CONSTRAINTTOL),
-                                np.isclose(np.dot(C, trnX[i]), d),
-                            )), i
-                else:
-                    assert np.all(np.dot(G, trnX[i]) <= (h + CONSTRAINTTOL)), i
-                #assert np.all(np.dot(np.vstack(Gss[i]), trnX[i]) <= np.concatenate(hss[i])), i
-                #assert np.all(np.dot(G, trnX[i]) <= h), i
+            if self.verbose > 0:
+                # each training sample should satisfy the constraints of its
+                # own region
+                G_rows = np.repeat(np.arange(len(trnX)), np.diff(self.G_ptr))
+                C_rows = np.repeat(np.arange(len(trnX)), np.diff(self.C_ptr))
+                sat_G = np.einsum('rd,rd->r', self.G_all, trnX[G_rows]) \
+                        <= (self.h_all + CONSTRAINTTOL)
+                sat_C = np.isclose(np.einsum('rd,rd->r', self.C_all, trnX[C_rows]),
+                                   self.d_all)
+                assert np.all(sat_G), np.unique(G_rows[~sat_G])
+                assert np.all(sat_C), np.unique(C_rows[~sat_C])
         else:
             raise ValueError("Not supported method: %s", self.method)
 
@@ -295,47 +484,57 @@ class RFAttack(AttackModel):
         else:
             raise ValueError("norm %s not supported", self.norm)
 
+        regions = (self.G_all, self.G_ptr, self.h_all, self.C_all, self.C_ptr, self.d_all)
         clf = self.clf
         pred_y = clf.predict(X)
-        pred_trn_y = clf.predict(self.trnX)
 
         if self.method == 'all':
-            def _helper(target_x, target_y, pred_yi):
-                if pred_yi != target_y:
-                    # already incorrect
-                    return np.zeros_like(target_x)
-                temp_regions = [self.regions[i] for i in range(len(self.regions)) \
-                                if self.region_preds[i] != target_y]
+            def _helper(target_x, target_y):
+                region_ids = [i for i in range(len(self.regions)) \
+                              if self.region_preds[i] != target_y]
                 return get_sol_fn(target_x, target_y,
-                                  temp_regions, self.clf)
+                                  regions, region_ids, self.clf)
 
+            # the already incorrect ones need no perturbation
+            idxs = np.where(pred_y == y)[0]
             pert_xs = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
-                delayed(_helper)(X[i], y[i], pred_y[i]) for i in range(len(X)))
-            pert_X = np.array(pert_xs)
+                delayed(_helper)(X[i], y[i]) for i in idxs)
+            pert_X = np.zeros_like(X)
+            if len(idxs) > 0:
+                pert_X[idxs] = np.array(pert_xs)
 
             assert np.all(self.clf.predict(X + pert_X) != y)
 
         elif self.method == 'rev':
-            pert_X = np.zeros_like(X)
-            for sample_id in tqdm(range(len(X)), ascii=True, desc="Perturb"):
-                if pred_y[sample_id] != y[sample_id]:
-                    continue
-                target_x, target_y = X[sample_id], y[sample_id]
-
-                if self.n_searches != -1:
-                    ind = self.kd_tree.query(
+            def _search_ind(target_x, target_y):
+                if self.n_searches == -1:
+                    return self.trn_idx_by_not_class[target_y]
+                dists, ind = [], []
+                for c, kd_tree in self.kd_trees.items():
+                    if c == target_y:
+                        continue
+                    dist, local_ind = kd_tree.query(
                             target_x.reshape((1, -1)),
-                            k=len(self.trnX),
-                            return_distance=False)[0]
-                    ind = list(filter(lambda x: pred_trn_y[x] != target_y, ind))[:self.n_searches]
-                else:
-                    ind = list(filter(lambda x: pred_trn_y[x] != target_y, np.arange(len(self.trnX))))
-                temp_regions = [self.regions[i] for i in ind]
-                pert_x = get_sol_fn(target_x, y[sample_id], temp_regions, self.clf, self.trnX[ind])
-
+                            k=min(self.n_searches, len(self.kd_class_indices[c])))
+                    dists.append(dist[0])
+                    ind.append(self.kd_class_indices[c][local_ind[0]])
+                dists, ind = np.concatenate(dists), np.concatenate(ind)
+                return ind[np.argsort(dists, kind='stable')][:self.n_searches]
+
+            trnX = self.trnX
+            def _helper(target_x, target_y, ind):
+                return get_sol_fn(target_x, target_y, regions, ind, clf, trnX[ind])
+
+            # the already incorrect ones need no perturbation
+            idxs = np.where(pred_y == y)[0]
+            pert_xs = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(_helper)(X[i], y[i], _search_ind(X[i], y[i]))
+                for i in tqdm(idxs, ascii=True, desc="Perturb"))
+            pert_X = np.zeros_like(X)
+            for i, pert_x in zip(idxs, pert_xs):
                 if np.linalg.norm(pert_x) != 0:
-                    assert self.clf.predict([X[sample_id] + pert_x])[0] != y[sample_id]
-                    pert_X[sample_id, :] = pert_x
+                    assert self.clf.predict([X[i] + pert_x])[0] != y[i]
+                    pert_X[i, :] = pert_x
                 else:
                     raise ValueError("shouldn't happen")
         else: